@@ -5,20 +5,101 @@ here because A. the code is stable and B. to avoid more
 unnecessary external dependencies than necessary.  All credit
 for the following code to GitHub users Alireza & Chip Warden
 (https://github.com/scisco/area).
+
+The ring kernel has since been vectorized with numpy (already
+pulled in by shapely and rasterio).
 """
 
 from __future__ import division
-import json
+from itertools import chain
 from math import pi, sin
+import numpy as np
+
+try:
+    from orjson import loads as _loads
+except ImportError:
+    from json import loads as _loads
 
 WGS84_RADIUS = 6378137
 
+# Below this many vertices, building the numpy array costs more than the loop it replaces
+_NUMPY_MIN_VERTICES = 2048
+
 
 def rad(value):
     return value * pi / 180
 
 
-def ring__area(coordinates):
+def _ring_area_py(coordinates):
+    """
+    Pure-Python Chamberlain-Duquette kernel for short rings.  Longitudes
+        are differenced in degrees and converted once at the end.
+    """
+
+    d2r = pi / 180
+    n = len(coordinates)
+    _area = 0.0
+    prev_lon = coordinates[-1][0]
+    for i in range(n):
+        _area += (coordinates[(i + 1) % n][0] - prev_lon) * sin(coordinates[i][1] * d2r)
+        prev_lon = coordinates[i][0]
+
+    return _area * d2r * WGS84_RADIUS * WGS84_RADIUS / 2
+
+
+def _ring_area_quad(coordinates):
+    """
+    Unrolled Chamberlain-Duquette kernel for four-vertex rings, open or
+        closed, such as the bounding boxes produced by the handlers.
+    """
+
+    d2r = pi / 180
+    c0, c1, c2, c3 = coordinates[0], coordinates[1], coordinates[2], coordinates[3]
+    x0, x1, x2, x3 = c0[0], c1[0], c2[0], c3[0]
+    y0, y1, y2, y3 = c0[1], c1[1], c2[1], c3[1]
+
+    if len(coordinates) == 5:
+        x4, y4 = coordinates[4][0], coordinates[4][1]
+        _area = ((x1 - x4) * sin(y0 * d2r) + (x2 - x0) * sin(y1 * d2r) + (x3 - x1) * sin(y2 * d2r)
+                 + (x4 - x2) * sin(y3 * d2r) + (x0 - x3) * sin(y4 * d2r))
+    else:
+        _area = ((x1 - x3) * sin(y0 * d2r) + (x2 - x0) * sin(y1 * d2r) + (x3 - x1) * sin(y2 * d2r)
+                 + (x0 - x2) * sin(y3 * d2r))
+
+    return _area * d2r * WGS84_RADIUS * WGS84_RADIUS / 2
+
+
+def _ring_area_girard(coords):
+    """
+    Spherical excess of a ring, following the per-edge formulation used by
+        d3.geo.area.  Rather than calling atan2 once per edge, the edge terms
+        are multiplied together as unit complex numbers and a single
+        np.angle recovers their summed argument, since sum(arg(z)) = arg(prod(z)).
+        The identity holds while the summed angle stays within (-pi, pi],
+        i.e. for rings covering less than a hemisphere.
+
+    @Returns
+
+    {float} The approximate signed geodesic _area of the ring in square metres.
+    """
+
+    lon = np.deg2rad(coords[:, 0])
+    phi = np.deg2rad(coords[:, 1]) / 2 + pi / 4
+    cos_phi = np.cos(phi)
+    sin_phi = np.sin(phi)
+
+    # Edges run from each vertex to the next, closing back to the first
+    cos_phi1 = np.roll(cos_phi, -1)
+    sin_phi1 = np.roll(sin_phi, -1)
+    dlon = np.roll(lon, -1) - lon
+
+    k = sin_phi * sin_phi1
+    z = (cos_phi * cos_phi1 + k * np.cos(dlon)) + 1j * (k * np.sin(dlon))
+
+    return 2 * float(np.angle(np.prod(z / np.abs(z)))) * WGS84_RADIUS * WGS84_RADIUS
+
+
+def ring__area(coordinates, girard=False):
     """
     Calculate the approximate _area of the polygon where it
         is projected onto the earth. Note that this _area will be
@@ -34,69 +115,94 @@ def ring__area(coordinates):
     @Returns
 
     {float} The approximate signed geodesic _area of the polygon in square metres.
+
+    Pass girard=True to use the great-circle (d3.geo.area) formulation
+        instead of the Chamberlain-Duquette approximation.  Rings may also
+        be given as an (n, 2+) numpy array, which skips list conversion.
     """
 
-    assert isinstance(coordinates, (list, tuple))
+    assert isinstance(coordinates, (list, tuple, np.ndarray))
 
-    _area = 0
     coordinates_length = len(coordinates)
+    if coordinates_length <= 2:
+        return 0
 
-    if coordinates_length > 2:
-        for i in range(0, coordinates_length):
-            if i == (coordinates_length - 2):
-                lower_index = coordinates_length - 2
-                middle_index = coordinates_length - 1
-                upper_index = 0
-            elif i == (coordinates_length - 1):
-                lower_index = coordinates_length - 1
-                middle_index = 0
-                upper_index = 1
-            else:
-                lower_index = i
-                middle_index = i + 1
-                upper_index = i + 2
-
-            p1 = coordinates[lower_index]
-            p2 = coordinates[middle_index]
-            p3 = coordinates[upper_index]
-
-            _area += (rad(p3[0]) - rad(p1[0])) * sin(rad(p2[1]))
-
-        _area = _area * WGS84_RADIUS * WGS84_RADIUS / 2
+    if not girard and not isinstance(coordinates, np.ndarray):
+        if coordinates_length in (4, 5):
+            return _ring_area_quad(coordinates)
+        if coordinates_length < _NUMPY_MIN_VERTICES:
+            return _ring_area_py(coordinates)
 
-    return _area
+    coords = np.asarray(coordinates, dtype=np.float64)
+    if girard:
+        return _ring_area_girard(coords)
+
+    lon = np.deg2rad(coords[:, 0])
+    lat = np.deg2rad(coords[:, 1])
+
+    # Each vertex contributes (lon[i + 1] - lon[i - 1]) * sin(lat[i]), wrapping around the ring
+    dlon = np.roll(lon, -1) - np.roll(lon, 1)
+
+    return float(np.dot(dlon, np.sin(lat))) * WGS84_RADIUS * WGS84_RADIUS / 2
+
+
+def ring_areas(rings):
+    """
+    Chamberlain-Duquette areas of many rings at once.  Every ring must have
+        the same number of vertices, e.g. the five-point bounding boxes the
+        handlers produce.
+
+    @Returns
+
+    {ndarray} The approximate signed geodesic _area of each ring in square metres.
+    """
+
+    if isinstance(rings, np.ndarray):
+        coords = rings.astype(np.float64, copy=False)
+    else:
+        # Flattening through fromiter is several times faster than asarray on nested tuples
+        n, k, dims = len(rings), len(rings[0]), len(rings[0][0])
+        coords = np.fromiter(chain.from_iterable(chain.from_iterable(rings)), dtype=np.float64)
+        if coords.size != n * k * dims:
+            raise ValueError('rings must all have the same number of vertices and dimensions')
+        coords = coords.reshape(n, k, dims)
 
+    lon = np.deg2rad(coords[:, :, 0])
+    lat = np.deg2rad(coords[:, :, 1])
+    dlon = np.roll(lon, -1, axis=1) - np.roll(lon, 1, axis=1)
 
-def polygon_area(coordinates):
+    return (dlon * np.sin(lat)).sum(axis=1) * WGS84_RADIUS * WGS84_RADIUS / 2
+
+
+def polygon_area(coordinates, girard=False):
 
     assert isinstance(coordinates, (list, tuple))
 
     _area = 0
     if len(coordinates) > 0:
-        _area += abs(ring__area(coordinates[0]))
+        _area += abs(ring__area(coordinates[0], girard))
 
         for i in range(1, len(coordinates)):
-            _area -= abs(ring__area(coordinates[i]))
+            _area -= abs(ring__area(coordinates[i], girard))
 
     return _area
 
 
-def area(geometry):
-    if isinstance(geometry, str):
-        geometry = json.loads(geometry)
+_AREA_HANDLERS = {
+    'Polygon': lambda g, girard: polygon_area(g['coordinates'], girard),
+    'MultiPolygon': lambda g, girard: sum(polygon_area(p, girard) for p in g['coordinates']),
+    'GeometryCollection': lambda g, girard: sum(area(x, girard) for x in g.get('geometries', [])),
+}
 
-    assert isinstance(geometry, dict)
 
-    _area = 0
+def area(geometry, girard=False):
+    if isinstance(geometry, (str, bytes)):
+        geometry = _loads(geometry)
 
-    if geometry['type'] == 'Polygon':
-        return polygon_area(geometry['coordinates'])
-    elif geometry['type'] == 'MultiPolygon':
-        for i in range(0, len(geometry['coordinates'])):
-            _area += polygon_area(geometry['coordinates'][i])
+    assert isinstance(geometry, dict)
 
-    elif geometry['type'] == 'GeometryCollection':
-        for i in range(0, len(geometry['geometries'])):
-            _area += area(geometry['geometries'][i])
+    handler = _AREA_HANDLERS.get(geometry['type'])
+    if handler is None:
+        return 0
 
-    return _area
+    return handler(geometry, girard)
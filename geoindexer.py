@@ -1,57 +1,330 @@
 """Documentation to follow"""
 
-from area import area
-from collections import OrderedDict
+from area import area, ring_areas
+from bisect import bisect_right
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from datetime import datetime
-import fiona
-from fiona.crs import from_epsg
 from handlers import Container, Exif, Lidar, Log, Raster, Shapefile
 import json
+import multiprocessing
+import numpy as np
 import os
-from pathlib import Path
+from osgeo import gdal, ogr, osr
+from struct import pack
 import sys
+from time import time
+import threading
 from tqdm import tqdm
 
+try:
+    from orjson import dumps as _dumps
+except ImportError:
+    def _dumps(obj):
+        return json.dumps(obj).encode()
+
+
+# Extension -> handler class, looked up once per file.  Each handler's CATEGORY names the get_extents statistic its
+# features count towards.
+PROCESSOR_MAP = {'gdb': Container, 'gpkg': Container, 'db': Container, 'sqlite': Container,
+                 'jpg': Exif, 'jpeg': Exif,
+                 'las': Lidar, 'laz': Lidar,
+                 'tif': Raster, 'tiff': Raster, 'ntf': Raster, 'nitf': Raster,
+                 'dt0': Raster, 'dt1': Raster, 'dt2': Raster,
+                 'shp': Shapefile}
+
+# Directory reads on one volume serialize in the filesystem (per-volume locks on APFS/NTFS), so crawl throughput
+# peaks around four threads and falls off beyond that; more threads only help on network or multi-disk storage
+CRAWL_WORKERS = min(4, os.cpu_count() or 4)
+
+# Directories that never hold data worth indexing; GeoCrawler skips them and everything below them
+PRUNE_DIRS = frozenset(['.git', '.hg', '.svn', '__pycache__', 'node_modules',
+                        '$RECYCLE.BIN', 'System Volume Information'])
+
+# Lower bounds (km2) of the scoped GeoPackage layers, level_06 up to level_00
+LEVEL_THRESHOLDS = (100000, 500000, 1000000, 5000000, 35000000, 175000000)
+LEVEL_NAMES = ['level_06', 'level_05', 'level_04', 'level_03', 'level_02', 'level_01', 'level_00']
+
+# SQLite settings for GeoPackage output: no fsync per commit, rollback journal kept in memory
+GPKG_WRITE_OPTIONS = {'OGR_SQLITE_SYNCHRONOUS': 'OFF',
+                      'OGR_SQLITE_JOURNAL': 'MEMORY'}
+
+
+# Format -> (second, formatted timestamp), so error lines logged within the same second share one strftime
+_NOW_CACHE = {}
+
 
 def now(iso8601=True):
-    if iso8601:
-        return datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
-    else:
-        return datetime.now().strftime('%Y%m%dT%H%M%S')
+    t = int(time())
+    cached = _NOW_CACHE.get(iso8601)
+    if cached is None or cached[0] != t:
+        fmt = '%Y-%m-%dT%H:%M:%S' if iso8601 else '%Y%m%dT%H%M%S'
+        cached = _NOW_CACHE[iso8601] = (t, datetime.fromtimestamp(t).strftime(fmt))
+    return cached[1]
+
+
+def _polygon_wkb(rings):
+    """
+    Packs GeoJSON polygon rings into 2D little-endian WKB, which OGR reads without going through a JSON parser.
+
+    :param rings: Polygon coordinates, exterior ring first
+    :type rings: list
+    :return: bytes
+    """
+    parts = [pack('<BII', 1, 3, len(rings))]
+    for ring in rings:
+        parts.append(pack('<I', len(ring)))
+        parts.append(pack(f'<{2 * len(ring)}d', *[c for xy in ring for c in xy[:2]]))
+    return b''.join(parts)
+
+
+def _process_file(filepath):
+    """
+    Runs the handler registered for a file's extension.  Kept at module level so it can be sent to worker
+    processes, and returns only plain data: the handler class, its features, error lines, failed layers and
+    whether the file as a whole failed, led by the path itself.
+
+    :param filepath: Path of the file to process
+    :type filepath: str
+    :return: tuple
+    """
+    processor = PROCESSOR_MAP.get(GeoIndexer.get_extension(filepath))
+    feats = []
+    errors = []
+    failed_layers = []
+    failed = False
+
+    try:
+        if processor is Container:
+            cf = Container(filepath).get_props()
+            feats, errors, failed_layers = cf['feats'], cf['errors'], cf['failed_layers']
+        elif processor:
+            feat = processor(filepath).get_props()
+            assert feat is None or isinstance(feat, dict), f'{processor.__name__}.get_props returned {type(feat)}'
+            if feat:
+                feats.append(feat)
+            else:
+                errors.append(f'{now()} - Problem processing {processor.__name__} {filepath}')
+                failed = True
+    except Exception as e:
+        errors.append(f'{now()} - {e} - [{filepath}]')
+        failed = True
+
+    return filepath, processor, feats, errors, failed_layers, failed
 
 
 class GeoCrawler:
 
-    def __init__(self, path, types):
+    def __init__(self, path, types, prune=PRUNE_DIRS, max_results=None, max_seconds=None):
         """
-        GeoCrawler constructor
+        GeoCrawler constructor.  max_results and max_seconds bound a search on shares too large or too slow to
+        walk completely: once either is reached the search returns the matches handed back so far.  The clock
+        starts when the first match is requested.  In a recursive search a directory read that hangs (e.g. a dead
+        network mount) does not hold up the return: the search ends on time, leaving that read to finish on a
+        background thread, and matches still held by that thread are not reported.
 
         :param path: The path to be crawled
         :type path: str
         :param types: List of file extensions
         :type types: list
+        :param prune: Directory names that are never descended into (default: PRUNE_DIRS)
+        :type prune: iterable
+        :param max_results: Stop after this many matches (default: no limit)
+        :type max_results: int
+        :param max_seconds: Stop after this many seconds of searching (default: no limit)
+        :type max_seconds: float
         """
         self.path = path
         self.types = types
+        self.prune = frozenset(prune or ())
+        self.max_results = max_results
+        self.max_seconds = max_seconds
+        self._types_set = frozenset(t.lower() for t in types)
 
-    def get_file_list(self, recursive=True):
+    def _scandir_walk(self, root, recursive=True, deadline=None):
         """
-        Searches path (default recursive) for filetypes and returns list of matches.
+        Walks root with os.scandir and yields the paths of entries whose extension (case-insensitive) is in
+        self.types.  Matching directories (e.g. File Geodatabases) are yielded and not descended into.
+        Directories are kept on an explicit stack, so deep trees cannot hit the recursion limit.
 
-        :param recursive: Traverse directories recursively (default: True)
+        :param root: Absolute path of the directory to walk
+        :type root: str
+        :param recursive: Descend into subdirectories (default: True)
         :type recursive: bool
-        :return: list
+        :param deadline: time() after which no further directories are read (default: none)
+        :type deadline: float
+        :return: generator
         """
-        if recursive:
+        stack = deque([root])
+        while stack:
+            if deadline is not None and time() >= deadline:
+                return
             try:
-                return [str(p.resolve()) for p in Path(self.path).glob("**/*") if p.suffix[1:] in self.types]
-            except PermissionError:
-                pass
-        else:
+                with os.scandir(stack.pop()) as it:
+                    for entry in it:
+                        stem, dot, ext = entry.name.rpartition('.')
+                        if dot and stem and ext.lower() in self._types_set:
+                            yield entry.path
+                        elif recursive and entry.is_dir(follow_symlinks=False) and entry.name not in self.prune:
+                            stack.append(entry.path)
+            except (PermissionError, FileNotFoundError):
+                continue
+
+    def _scan_subtree(self, directory, max_pending=4, stop=None):
+        """
+        Walks directory on the calling thread, keeping at most max_pending subdirectories queued locally.
+        Any surplus is handed back to the caller so it can be spread over other workers, which keeps small
+        subtrees on one thread and only splits the work where there is enough of it.
+
+        :param directory: Absolute path of the directory to walk
+        :type directory: str
+        :param max_pending: Subdirectories a worker keeps for itself before handing the rest back (default: 4)
+        :type max_pending: int
+        :param stop: Event that ends the walk early, dropping whatever is left of the subtree
+        :type stop: threading.Event
+        :return: tuple
+        """
+        matches = []
+        surplus = []
+        stack = [directory]
+        while stack:
+            if stop is not None and stop.is_set():
+                return matches, []
             try:
-                return [str(p.resolve()) for p in Path(self.path).glob("*") if p.suffix[1:] in self.types]
-            except PermissionError:
+                with os.scandir(stack.pop()) as it:
+                    for entry in it:
+                        stem, dot, ext = entry.name.rpartition('.')
+                        if dot and stem and ext.lower() in self._types_set:
+                            matches.append(entry.path)
+                        elif entry.is_dir(follow_symlinks=False) and entry.name not in self.prune:
+                            stack.append(entry.path)
+            except (PermissionError, FileNotFoundError):
                 pass
+            if len(stack) > max_pending:
+                surplus.extend(stack[max_pending:])
+                del stack[max_pending:]
+        return matches, surplus
+
+    def _parallel_walk(self, root, workers=CRAWL_WORKERS, deadline=None):
+        """
+        Walks root with a pool of threads.  Each worker walks a subtree and submits the subdirectories it
+        cannot keep for itself back to the pool, so wide trees keep every worker busy.
+
+        :param root: Absolute path of the directory to walk
+        :type root: str
+        :param workers: Number of scanning threads (default: CRAWL_WORKERS)
+        :type workers: int
+        :param deadline: time() at which the walk stops (default: none)
+        :type deadline: float
+        :return: generator
+        """
+        # A deadline needs the scan off the calling thread, so a hung directory read cannot hold up the return
+        if workers <= 1 and deadline is None:
+            yield from self._scandir_walk(root)
+            return
+
+        stop = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=workers)
+        pending = {executor.submit(self._scan_subtree, root, stop=stop)}
+        try:
+            while pending:
+                timeout = None if deadline is None else max(0.0, deadline - time())
+                done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                if not done:
+                    return
+                for future in done:
+                    matches, subdirs = future.result()
+                    pending.update(executor.submit(self._scan_subtree, d, stop=stop) for d in subdirs)
+                    yield from matches
+        finally:
+            if pending:
+                # The walk ended early: drop queued subtrees, stop running ones at their next directory, and
+                # don't wait for a thread stuck in a directory read
+                stop.set()
+                executor.shutdown(wait=False, cancel_futures=True)
+            else:
+                executor.shutdown(wait=True)
+
+    def iter_files(self, recursive=True, workers=CRAWL_WORKERS, resolve=False):
+        """
+        Searches path (default recursive) for filetypes and yields matches as they are found, so they can be
+        processed while the search is still running.
+
+        :param recursive: Traverse directories recursively (default: True)
+        :type recursive: bool
+        :param workers: Number of threads used for a recursive search, 1 to search serially
+                        (default: CRAWL_WORKERS)
+        :type workers: int
+        :param resolve: Resolve symlinks in the search path, once, so matches are reported under its canonical
+                        location; matches themselves are never resolved (default: False)
+        :type resolve: bool
+        :return: generator
+        """
+        root = os.path.realpath(self.path) if resolve else os.path.abspath(self.path)
+        if self.max_results or self.max_seconds:
+            return self._within_budget(root, recursive, workers)
+        return self._walk(root, recursive, workers)
+
+    def _walk(self, root, recursive, workers, deadline=None):
+        """
+        Threaded walk of root, or a serial one of root alone when recursive is False.
+
+        :return: generator
+        """
+        if recursive:
+            return self._parallel_walk(root, workers=workers, deadline=deadline)
+        return self._scandir_walk(root, recursive=False, deadline=deadline)
+
+    def _within_budget(self, root, recursive, workers):
+        """
+        Walks root and passes matches through until max_results have been yielded or max_seconds have passed,
+        then closes the walk so its threads stop.  The deadline is set when the first match is requested, not
+        when the generator is created.
+
+        :return: generator
+        """
+        deadline = time() + self.max_seconds if self.max_seconds else None
+        walk = self._walk(root, recursive, workers, deadline)
+        found = 0
+        try:
+            for path in walk:
+                yield path
+                found += 1
+                if self.max_results and found >= self.max_results:
+                    return
+                if deadline is not None and time() >= deadline:
+                    return
+        finally:
+            walk.close()
+
+    def get_file_list(self, recursive=True, workers=CRAWL_WORKERS, by_inode=False, resolve=False):
+        """
+        Searches path (default recursive) for filetypes and returns list of matches.
+
+        :param recursive: Traverse directories recursively (default: True)
+        :type recursive: bool
+        :param workers: Number of threads used for a recursive search, 1 to search serially
+                        (default: CRAWL_WORKERS)
+        :type workers: int
+        :param by_inode: Order the matches by device and inode, which roughly follows their layout on disk and
+                         cuts seeking when they are processed from spinning disks (default: False)
+        :type by_inode: bool
+        :param resolve: Resolve symlinks in the search path once, see iter_files (default: False)
+        :type resolve: bool
+        :return: list
+        """
+        files = list(self.iter_files(recursive=recursive, workers=workers, resolve=resolve))
+        if by_inode:
+            files.sort(key=GeoCrawler._inode_key)
+        return files
+
+    @staticmethod
+    def _inode_key(path):
+        try:
+            st = os.stat(path)
+            return st.st_dev, st.st_ino
+        except OSError:
+            return -1, -1
 
 
 class GeoIndexer:
@@ -59,143 +332,130 @@ class GeoIndexer:
     def __init__(self, file_list):
         """
         GeoIndexer constructor
+
+        :param file_list: Paths to process, as a list or any iterable such as GeoCrawler.iter_files()
+        :type file_list: iterable
         """
         self.file_list = file_list
         self.errors = []
         self.failures = {'files': [],
                          'layers': []}
 
-    def get_extents(self, logging=None):
-
-        # Get total number of datasets to process, including geodatabase layers
-        if len(self.file_list) > 0:
-
-            to_process = 0
-            for f in self.file_list:
-                to_process += GeoIndexer.get_layer_num(self, f)
-
-            # Set up the output
-            points = []
-            polygons = []
-            extents = {'type': 'FeatureCollection',
-                       'features': []}
-
-            # Set up the report
-            stats = {'container_layers': 0,
-                     'web_images': 0,
-                     'lidar_point_clouds': 0,
-                     'rasters': 0,
-                     'shapefiles': 0}
-
-            # Main iterator
-            for f in tqdm(self.file_list, desc='GeoIndexer progress', total=len(self.file_list), dynamic_ncols=True):
-                fext = GeoIndexer.get_extension(f)
-
-                if fext in ['gdb', 'gpkg', 'db', 'sqlite']:
-                    try:
-                        cf = Container(f).get_props()
-                        for feat in cf['feats']:
-                            if feat:
-                                polygons.append(feat)
-                                stats['container_layers'] += 1
-                            else:
-                                self.errors.append(f'{now()} - Problem processing layer {feat} in {f}')
-                                self.failures['layers'].append(f'{feat} ({f})')
-                        if len(cf['errors']) > 0:
-                            self.errors.append([e for e in cf['errors']])
-                            self.failures['layers'].append([f for f in cf['failed_layers']])
-                    except Exception as e:
-                        self.errors.append(f'{now()} - {e} - [{f}]')
-                        self.failures['files'].append(f)
-                        pass
-
-                elif fext in ['jpg', 'jpeg']:
-                    try:
-                        points.append(Exif(f).get_props())
-                        stats['web_images'] += 1
-                    except Exception as e:
-                        self.errors.append(f'{now()} - {e} - [{f}]')
-                        self.failures['files'].append(f)
-                        pass
-
-                elif fext in ['laz', 'las']:
-                    try:
-                        lf = Lidar(f).get_props()
-                        if lf:
-                            polygons.append(lf)
-                            stats['lidar_point_clouds'] += 1
-                        else:
-                            self.errors.append(f'{now()} - Problem processing Lidar file {f}')
-                            self.failures['files'].append(f)
-                    except Exception as e:
-                        self.errors.append(f'{now()} - {e} - [{f}]')
-                        pass
-
-                elif fext in ['tiff', 'tif', 'ntf', 'nitf', 'dt0', 'dt1', 'dt2']:
-                    try:
-                        feat = Raster(f).get_props()
-                        if feat:
-                            polygons.append(feat)
-                            stats['rasters'] += 1
-                        else:
-                            self.errors.append(f'{now()} - Problem accessing Raster {f}')
-                            self.failures['files'].append(f)
-                    except Exception as e:
-                        self.errors.append(f'{now()} - {e} - [{f}]')
-                        self.failures['files'].append(f)
-                        pass
-
-                elif fext == 'shp':
-                    try:
-                        feat = Shapefile(f).get_props()
-                        if feat:
-                            polygons.append(feat)
-                            stats['shapefiles'] += 1
-                        else:
-                            self.errors.append(f'{now()} - Problem accessing Shapefile {f}')
-                            self.failures['files'].append(f)
-                    except Exception as e:
-                        self.errors.append(f'{now()} - {e} - [{f}]')
-                        self.failures['files'].append(f)
-                        pass
-
-            # Assemble the GeoJSON object
-            if len(polygons) > 0:
-                for poly in polygons:
-                    extents['features'].append(poly)
-            if len(points) > 0:
-                for point in points:
-                    extents['features'].append(point)
-
-            # Summary statistics
-            stats['total_processed'] = sum([val for key, val in stats.items()])
-            stats['total_datasets'] = to_process
-            stats['success_rate'] = round(
-                ((float(stats.get('total_processed', 0)) / float(stats.get('total_datasets', 0))) * 100), 2)
-
-            # Output log if true
-            if logging:
-                log = Log(self.errors)
-                logname = log.to_file(logging)
-                stats['logfile'] = f'file:///{str(os.path.join(logging, logname))}'.replace("\\", "/")
-
-            return extents, stats, self.failures
+    def get_extents(self, logging=None, workers=None):
+        """
+        Processes every file in the list and returns the coverage FeatureCollection, summary statistics and
+        failures.  Files are processed in parallel on a pool of worker processes.  If file_list is a generator
+        the workers start on the first files while the rest are still being found.
+
+        :param logging: Directory to write the error log to (default: no log)
+        :type logging: str
+        :param workers: Number of worker processes, 1 to process in this process (default: os.cpu_count())
+        :type workers: int
+        :return: tuple
+        """
 
+        # Set up the output
+        points = []
+        polygons = []
+
+        # Set up the report
+        stats = {'container_layers': 0,
+                 'web_images': 0,
+                 'lidar_point_clouds': 0,
+                 'rasters': 0,
+                 'shapefiles': 0}
+
+        # Main iterator
+        if workers == 1:
+            results = map(_process_file, self.file_list)
+            processed, to_process = self._collect(results, points, polygons, stats)
         else:
+            workers = workers or os.cpu_count() or 1
+
+            # Never fork the workers: a GeoCrawler.iter_files() input has scanning threads running in this
+            # process by the time the first file is submitted, and a forked child can deadlock on their locks
+            start = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            with ProcessPoolExecutor(max_workers=workers,
+                                     mp_context=multiprocessing.get_context(start)) as executor:
+                results = GeoIndexer._map_bounded(executor, _process_file, self.file_list, window=4 * workers)
+                processed, to_process = self._collect(results, points, polygons, stats)
+
+        if not processed:
             sys.exit('No files found to process.')
 
+        # Assemble the GeoJSON object
+        extents = {'type': 'FeatureCollection',
+                   'features': polygons + points}
+
+        # Summary statistics
+        stats['total_processed'] = sum([val for key, val in stats.items()])
+        stats['total_datasets'] = to_process
+        stats['success_rate'] = round(
+            ((float(stats.get('total_processed', 0)) / float(stats.get('total_datasets', 0) or 1)) * 100), 2)
+
+        # Output log if true
+        if logging:
+            log = Log(self.errors)
+            logname = log.to_file(logging)
+            stats['logfile'] = f'file:///{str(os.path.join(logging, logname))}'.replace("\\", "/")
+
+        return extents, stats, self.failures
+
+    @staticmethod
+    def _map_bounded(executor, fn, iterable, window):
+        """
+        Like executor.map, but submits lazily and keeps at most window tasks in flight, so a generator input
+        is consumed as results come back rather than all up front.  Results are yielded in input order.
+
+        :param window: Maximum number of submitted, unfinished tasks
+        :type window: int
+        :return: generator
+        """
+        in_flight = deque()
+        for item in iterable:
+            if len(in_flight) >= window:
+                yield in_flight.popleft().result()
+            in_flight.append(executor.submit(fn, item))
+        while in_flight:
+            yield in_flight.popleft().result()
+
+    def _collect(self, results, points, polygons, stats):
+        """
+        Merges per-file results from _process_file, in file list order, into the output and the report.
+
+        :return: The number of files, and of datasets seen: one per file, or one per layer read from a container
+        """
+        files = 0
+        datasets = 0
+        total = len(self.file_list) if hasattr(self.file_list, '__len__') else None
+        for f, processor, feats, errors, failed_layers, failed in tqdm(results,
+                                                                       desc='GeoIndexer progress',
+                                                                       total=total,
+                                                                       unit='file',
+                                                                       mininterval=0.5,
+                                                                       dynamic_ncols=True):
+            files += 1
+            if feats:
+                (points if processor is Exif else polygons).extend(feats)
+                stats[processor.CATEGORY] += len(feats)
+            datasets += len(feats) + len(failed_layers) if processor is Container else 1
+            self.errors.extend(errors)
+            self.failures['layers'].extend(failed_layers)
+            if failed:
+                self.failures['files'].append(f)
+
+        return files, datasets
+
     def get_layer_num(self, filepath: str):
         """
-        Get the number of layers within a container, if the file is a container and can be read by fiona.
+        Get the number of layers within a container, if the file is a container and can be read by OGR.
         Otherwise, return 0 (if the container cannot be read) or 1 (if the file is not a container).
 
         :return: int
         """
-        extension = GeoIndexer.get_extension(filepath)
-        if extension in ['gdb', 'gpkg', 'db', 'sqlite']:
+        if PROCESSOR_MAP.get(GeoIndexer.get_extension(filepath)) is Container:
             try:
-                numlayers = len(fiona.listlayers(filepath))
-                return numlayers
+                return Container(filepath).get_layer_count()
             except Exception as e:
                 self.errors.append(f'{now()} - {e} - [{filepath}]')
                 return 0
@@ -205,7 +465,12 @@ class GeoIndexer:
     @staticmethod
     def get_extension(filepath: str):
         if filepath:
-            return os.path.splitext(os.path.split(filepath)[1])[1][1:].lower()
+            # Last dot after the last separator, with at least one character of name before it
+            i = filepath.rfind('.')
+            sep = filepath.rfind(os.sep)
+            if os.altsep:
+                sep = max(sep, filepath.rfind(os.altsep))
+            return filepath[i + 1:].lower() if i > sep + 1 else ''
         return None
 
     @staticmethod
@@ -217,20 +482,87 @@ class GeoIndexer:
     def get_schema(img_popup=False):
         if img_popup:
             return {'geometry': 'Point',
-                    'properties': OrderedDict([
-                        ('dataType', 'str'),
-                        ('fname', 'str'),
-                        ('path', 'str'),
-                        ('img_popup', 'str'),
-                        ('native_crs', 'int'),
-                        ('lastmod', 'str')])}
+                    'properties': {
+                        'dataType': 'str',
+                        'fname': 'str',
+                        'path': 'str',
+                        'img_popup': 'str',
+                        'native_crs': 'int',
+                        'lastmod': 'str'}}
         return {'geometry': 'Polygon',
-                'properties': OrderedDict([
-                    ('path', 'str'),
-                    ('lastmod', 'str'),
-                    ('fname', 'str'),
-                    ('dataType', 'str'),
-                    ('native_crs', 'int')])}
+                'properties': {
+                    'path': 'str',
+                    'lastmod': 'str',
+                    'fname': 'str',
+                    'dataType': 'str',
+                    'native_crs': 'int'}}
+
+    @staticmethod
+    def to_geojson(features: dict, path: str):
+        """
+        Writes a FeatureCollection to a GeoJSON file, one feature at a time, so the whole document is never
+        held in memory as a single string.  Features are encoded with orjson when it is installed.
+        """
+        with open(path, 'wb') as out:
+            out.write(b'{"type": "FeatureCollection", "features": [\n')
+            for i, feat in enumerate(features['features']):
+                if i:
+                    out.write(b',\n')
+                out.write(_dumps(feat))
+            out.write(b'\n]}\n')
+
+        return True
+
+    @staticmethod
+    def to_ndjson(features: dict, path: str):
+        """
+        Writes a FeatureCollection as newline-delimited GeoJSON (GeoJSONSeq), one feature per line, so very
+        large outputs can be read back a feature at a time by line-oriented tools and GDAL's GeoJSONSeq
+        driver.  Features are encoded with orjson when it is installed.
+        """
+        with open(path, 'wb') as out:
+            for feat in features['features']:
+                out.write(_dumps(feat))
+                out.write(b'\n')
+
+        return True
+
+    @staticmethod
+    def _areas_km2(feats):
+        """
+        Areas (km2) of a list of features.  Single-ring polygons, which covers the bounding boxes every handler
+        produces, are grouped by vertex count and dimension and measured one group at a time in numpy; anything
+        else goes through area() one feature at a time.  Features that cannot be measured get NaN.
+
+        :return: numpy.ndarray
+        """
+        areas = np.full(len(feats), np.nan)
+        by_length = defaultdict(list)
+        for i, f in enumerate(feats):
+            try:
+                geom = f['geometry']
+                if geom['type'] == 'Polygon' and len(geom['coordinates']) == 1 and len(geom['coordinates'][0]) > 3:
+                    ring = geom['coordinates'][0]
+                    by_length[len(ring), len(ring[0])].append(i)
+                    continue
+            except (TypeError, KeyError, AttributeError):
+                continue
+            areas[i] = GeoIndexer._area_km2(f)
+
+        for idx in by_length.values():
+            try:
+                areas[idx] = np.abs(ring_areas([feats[i]['geometry']['coordinates'][0] for i in idx])) / 1000000
+            except (TypeError, ValueError, IndexError):
+                areas[idx] = [GeoIndexer._area_km2(feats[i]) for i in idx]
+
+        return areas
+
+    @staticmethod
+    def _area_km2(feature):
+        try:
+            return area(feature['geometry']) / 1000000
+        except (TypeError, KeyError, AttributeError):
+            return np.nan
 
     @staticmethod
     def to_geopackage(features: dict, path: str, scoped=True):
@@ -245,68 +577,183 @@ class GeoIndexer:
         -- lv6: >= 50,000, < 100,000
         -- lv7: > 0, < 50,000
         """
-        driver = "GPKG"
-
         if scoped:
 
-            layers = {'level_00': GeoIndexer.geojson_container(),
-                      'level_01': GeoIndexer.geojson_container(),
-                      'level_02': GeoIndexer.geojson_container(),
-                      'level_03': GeoIndexer.geojson_container(),
-                      'level_04': GeoIndexer.geojson_container(),
-                      'level_05': GeoIndexer.geojson_container(),
-                      'level_06': GeoIndexer.geojson_container()}
-
-            for f in features['features']:
-                try:
-                    feat_area = float(area(f['geometry']) / 1000000)
-                    if feat_area >= 175000000:  # lv0, world
-                        layers['level_00']['features'].append(f)
-                    elif 35000000 <= feat_area < 175000000:
-                        layers['level_01']['features'].append(f)
-                    elif 5000000 <= feat_area < 35000000:
-                        layers['level_02']['features'].append(f)
-                    elif 1000000 <= feat_area < 5000000:
-                        layers['level_03']['features'].append(f)
-                    elif 500000 <= feat_area < 1000000:
-                        layers['level_04']['features'].append(f)
-                    elif 100000 <= float(feat_area) < 500000:
-                        layers['level_05']['features'].append(f)
-                    elif 0 < float(feat_area) < 100000:
-                        layers['level_06']['features'].append(f)
-                except (TypeError, KeyError, AttributeError):
-                    pass
-
-            for k, v in layers.items():
-                if len(v['features']) >= 1:
-                    with fiona.open(path, 'w',
-                                    schema=GeoIndexer.get_schema(),
-                                    driver=driver,
-                                    crs=from_epsg(4326),
-                                    layer=k) as outlyr:
-                        outlyr.writerecords(v['features'])
-                        # print(f'wrote layer {k}:')
-                        # print(f'{json.dumps(v)}')
-
-                    # Uncomment below to use geopandas instead of fiona
-                    # import geopandas as gpd
-                    # gdf = gpd.GeoDataFrame.from_features(v)
-                    # gdf.crs = 'EPSG:4326'
-                    # gdf.to_file(path, driver=driver, layer=k)
+            feats = features['features']
+            areas = GeoIndexer._areas_km2(feats)
+
+            # Bucket every feature at once; zero, negative and unmeasurable (NaN) areas are left out
+            levels = np.searchsorted(LEVEL_THRESHOLDS, areas, side='right')
+            levels[~(areas > 0)] = -1
+            order = np.argsort(levels, kind='stable')
+            bounds = np.searchsorted(levels[order], np.arange(len(LEVEL_NAMES) + 1))
+
+            layers = {}
+            for lv in range(len(LEVEL_NAMES) - 1, -1, -1):
+                layers[LEVEL_NAMES[lv]] = [feats[i] for i in order[bounds[lv]:bounds[lv + 1]]]
+
+            with GeoPackageWriter(path) as writer:
+                for k, v in layers.items():
+                    for f in v:
+                        writer.add(f, layer=k)
+
+            # Uncomment below to use geopandas instead
+            # import geopandas as gpd
+            # for k, v in layers.items():
+            #     gdf = gpd.GeoDataFrame.from_features(v)
+            #     gdf.crs = 'EPSG:4326'
+            #     gdf.to_file(path, driver='GPKG', layer=k)
 
             return True
 
         else:
             layername = f"coverages_{now(iso8601=False)}"
-            with fiona.open(path, 'w',
-                            schema=GeoIndexer.get_schema(),
-                            driver=driver,
-                            crs=from_epsg(4326),
-                            layer=layername) as outlyr:
-                outlyr.writerecords(features['features'])
-
-            # Uncomment below to use geopandas instead of fiona
+            with GeoPackageWriter(path, scoped=False, layer=layername) as writer:
+                for f in features['features']:
+                    writer.add(f)
+
+            # Uncomment below to use geopandas instead
             # import geopandas as gpd
             # gdf = gpd.GeoDataFrame.from_features(features)
             # gdf.crs = 'EPSG:4326'
-            # gdf.to_file(path, driver=driver, layer=layername)
+            # gdf.to_file(path, driver='GPKG', layer=layername)
+
+
+class GeoPackageWriter:
+
+    def __init__(self, path, scoped=True, layer=None, batch_size=10000):
+        """
+        Streams features into a GeoPackage through a single OGR datasource, so features can be written as they
+        are produced instead of being collected first.  Rows are committed every batch_size features, each
+        layer is created on its first feature (replacing an existing layer of the same name, leaving the others
+        in place), and spatial indexes are built once, on close, instead of being updated on every insert.
+
+        :param path: Path of the GeoPackage, created if it does not exist
+        :type path: str
+        :param scoped: Route features into the level_00 to level_06 layers by area (default: True)
+        :type scoped: bool
+        :param layer: Layer to write to when not scoped (default: coverages_<timestamp>)
+        :type layer: str
+        :param batch_size: Number of features per transaction (default: 10000)
+        :type batch_size: int
+        """
+        self.path = path
+        self.scoped = scoped
+        self.layer = layer or f'coverages_{now(iso8601=False)}'
+        self.batch_size = batch_size
+        self._fields = GeoIndexer.get_schema()['properties']
+        self._srs = osr.SpatialReference()
+        self._srs.ImportFromEPSG(4326)
+        self._layers = {}
+        self._pending = 0
+
+        for k, v in GPKG_WRITE_OPTIONS.items():
+            gdal.SetThreadLocalConfigOption(k, v)
+
+        if os.path.exists(path):
+            self._ds = ogr.Open(path, update=1)
+        else:
+            self._ds = ogr.GetDriverByName('GPKG').CreateDataSource(path)
+        if self._ds is None:
+            self._reset_options()
+            raise IOError(f'Could not open {path} for writing')
+
+        self._ds.StartTransaction()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self._ds is not None:
+            self._ds.RollbackTransaction()
+            self._layers = {}
+            self._ds = None
+            self._reset_options()
+
+    @staticmethod
+    def _reset_options():
+        for k in GPKG_WRITE_OPTIONS:
+            gdal.SetThreadLocalConfigOption(k, None)
+
+    def _get_layer(self, name):
+        lyr = self._layers.get(name)
+        if lyr is None:
+            for i in range(self._ds.GetLayerCount()):
+                if self._ds.GetLayerByIndex(i).GetName() == name:
+                    self._ds.DeleteLayer(i)
+                    break
+
+            # An unscoped layer also receives the image points, so it is declared as generic GEOMETRY
+            geom_type = ogr.wkbPolygon if self.scoped else ogr.wkbUnknown
+            lyr = self._ds.CreateLayer(name, self._srs, geom_type, options=['SPATIAL_INDEX=NO'])
+            if lyr is None:
+                raise IOError(f'Could not create layer {name} in {self.path}')
+            for field, ftype in self._fields.items():
+                lyr.CreateField(ogr.FieldDefn(field, ogr.OFTInteger if ftype == 'int' else ogr.OFTString))
+            self._layers[name] = lyr
+        return lyr
+
+    def add(self, feature, layer=None):
+        """
+        Writes one GeoJSON feature.  When scoped, the layer is picked from the feature's area unless given, and
+        features without a positive area (points, unreadable geometry) are skipped.
+
+        :param feature: GeoJSON feature
+        :type feature: dict
+        :param layer: Layer to write to, overriding the area routing
+        :type layer: str
+        :return: bool
+        """
+        if layer is None:
+            if self.scoped:
+                feat_area = GeoIndexer._area_km2(feature)
+                if not feat_area > 0:
+                    return False
+                layer = LEVEL_NAMES[bisect_right(LEVEL_THRESHOLDS, feat_area)]
+            else:
+                layer = self.layer
+
+        lyr = self._get_layer(layer)
+        out = ogr.Feature(lyr.GetLayerDefn())
+        props = feature['properties']
+        for field in self._fields:
+            value = props.get(field)
+            if value is not None:
+                out.SetField(field, value)
+        geom = feature['geometry']
+        if geom['type'] == 'Polygon':
+            out.SetGeometryDirectly(ogr.CreateGeometryFromWkb(_polygon_wkb(geom['coordinates'])))
+        else:
+            out.SetGeometryDirectly(ogr.CreateGeometryFromJson(_dumps(geom).decode()))
+        lyr.CreateFeature(out)
+
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self._ds.CommitTransaction()
+            self._ds.StartTransaction()
+            self._pending = 0
+        return True
+
+    def close(self):
+        """
+        Commits the remaining features, builds a spatial index for every layer written and closes the file.
+        """
+        if self._ds is None:
+            return
+        try:
+            self._ds.CommitTransaction()
+
+            self._ds.StartTransaction()
+            for name, lyr in self._layers.items():
+                table = name.replace("'", "''")
+                column = lyr.GetGeometryColumn().replace("'", "''")
+                res = self._ds.ExecuteSQL(f"SELECT CreateSpatialIndex('{table}', '{column}')")
+                if res is not None:
+                    self._ds.ReleaseResultSet(res)
+            self._ds.CommitTransaction()
+        finally:
+            self._layers = {}
+            self._ds = None
+            self._reset_options()
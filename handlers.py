@@ -1,21 +1,42 @@
-from collections import OrderedDict
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
+from math import isfinite
 from osgeo import gdal
-import geopandas as gpd
-import fiona
-import json
+import numpy as np
 import os
 from osgeo import ogr, osr
 from PIL import Image
-from PIL.ExifTags import TAGS, GPSTAGS
+from PIL.ExifTags import GPSTAGS
 import pyproj
 from pyproj import CRS
 import rasterio
-import re
-from shapely.geometry import mapping, Point, Polygon
+from shapely.geometry import mapping
+import struct
 import subprocess as sp
+import threading
+from xml.etree import ElementTree
 from zipfile import ZipFile
 
+try:
+    from orjson import loads as _loads
+except ImportError:
+    from json import loads as _loads
+
+
+# Extents come from the raster header, so skip listing the whole directory on every open.  Sidecar
+# files (.aux.xml, .tfw, ...) are still found by probing for them directly.
+RASTER_OPEN_OPTIONS = {'GDAL_DISABLE_READDIR_ON_OPEN': 'TRUE'}
+
+# LAS/LAZ public header: global encoding at 6, header size, offset to point data and VLR count at 94, then
+# max x, min x, max y, min y at 179.  LAZ keeps the header and VLRs uncompressed.
+_LAS_HEADER = struct.Struct('<4s2xH86xHII75x4d')
+_LAS_VLR_HEADER = struct.Struct('<2x16sHH32x')
+_LAS_WKT_BIT = 0x10
+_GEOKEY_PROJECTED_CS = 3072
+_GEOKEY_GEOGRAPHIC_CS = 2048
+
 
 class Log:
 
@@ -33,6 +54,8 @@ class Log:
 
 class Container:
 
+    CATEGORY = 'container_layers'
+
     def __init__(self, container):
         """
         Container constructor
@@ -40,6 +63,92 @@ class Container:
         self.container = container
         self.layer_errors = []
         self.failed_layers = []
+        self._local = threading.local()
+
+    def _get_datasource(self):
+        """
+        Opens the container once per thread with OGR and keeps the handle for every subsequent layer lookup.
+        OGR datasources must not be shared between threads.
+
+        :return: ogr.DataSource
+        """
+        ds = getattr(self._local, 'ds', None)
+        if ds is None:
+            ds = ogr.Open(self.container)
+            if ds is None:
+                raise FileNotFoundError(f'Could not open {self.container}')
+            self._local.ds = ds
+        return ds
+
+    def get_layer_count(self):
+        """
+        Number of layers in the container, read from the same OGR handle get_props uses.
+
+        :return: int
+        """
+        return self._get_datasource().GetLayerCount()
+
+    def _layer_failed(self, ln, e):
+        self.layer_errors.append(f"{datetime.now().strftime('%Y-%m-%dT%H:%M:%S')} - {e} - Could not process: {ln} | {self.container}")
+        self.failed_layers.append(f'{self.container} | {ln}')
+
+    def _layer_extent(self, index):
+        """
+        Reads the name, EPSG code and native (minx, miny, maxx, maxy) extent of a single layer of the container.
+
+        :param index: Layer index within the container
+        :type index: int
+        :return: tuple
+        """
+        lyr = self._get_datasource().GetLayerByIndex(index)
+        ln = lyr.GetName()
+        try:
+            lyr_crs = int(lyr.GetSpatialRef().GetAttrValue('AUTHORITY', 1))
+
+            # Prefer the extent stored in the layer header over a full scan
+            extent = lyr.GetExtent(force=0, can_return_null=True) or lyr.GetExtent()
+            return ln, lyr_crs, (extent[0], extent[2], extent[1], extent[3])
+
+        except (AttributeError, TypeError, ValueError, RuntimeError) as e:
+            self._layer_failed(ln, e)
+
+        return None
+
+    def _layer_records(self, lyr_crs, layers, datatype):
+        """
+        Builds the extent records for every layer sharing one CRS, reprojecting all of their extents together.
+
+        :param lyr_crs: EPSG code shared by the layers
+        :type lyr_crs: int
+        :param layers: (name, EPSG code, extent) tuples from _layer_extent
+        :type layers: list
+        :param datatype: Data type label for the records
+        :type datatype: str
+        :return: list
+        """
+        try:
+            extents = to_wgs84_many(lyr_crs, [extent for _, _, extent in layers])
+        except (TypeError, ValueError, RuntimeError) as e:
+            for ln, _, _ in layers:
+                self._layer_failed(ln, e)
+            return []
+
+        records = []
+        lastmod = moddate(self.container)
+        for (ln, _, _), (minx, miny, maxx, maxy) in zip(layers, extents):
+            boundary = bbox_geometry(minx, miny, maxx, maxy)
+
+            if maxx > minx and maxy > miny:
+                records.append(get_geojson_record(
+                    geom=boundary,
+                    datatype=datatype,
+                    fname=ln,
+                    path=self.container,
+                    nativecrs=lyr_crs,
+                    lastmod=lastmod
+                ))
+
+        return records
 
     def get_props(self):
         """
@@ -61,55 +170,21 @@ class Container:
             elif ext == 'db':
                 dt = 'SQLite Database Layer'
 
-            # process the db container
-            for ln in fiona.listlayers(self.container):
-                try:
-                    with fiona.open(self.container, layer=ln) as lyr:
-                        try:
-                            lyr_crs = lyr.crs['init'].split(':')[1]
-                            if lyr_crs != str(4326):
-                                minx, miny, maxx, maxy = to_wgs84(lyr_crs, lyr.bounds)
-
-                            else:
-                                bounds = lyr.bounds
-                                minx, miny, maxx, maxy = bounds[0], bounds[1], bounds[2], bounds[3]
-
-                            boundary = Polygon([
-                                [minx, miny],
-                                [maxx, miny],
-                                [maxx, maxy],
-                                [minx, maxy]
-                            ])
-
-                            if boundary.area > 0.0:
-                                feats.append(get_geojson_record(
-                                    geom=boundary,
-                                    datatype=dt,
-                                    fname=ln,
-                                    path=self.container,
-                                    nativecrs=lyr_crs,
-                                    lastmod=moddate(self.container)
-                                ))
-
-                        except (AttributeError, KeyError, fiona.errors.DriverError) as e:
-                            self.layer_errors.append(f"{datetime.now().strftime('%Y-%m-%dT%H:%M:%S')} - {e} - Could not process: {ln} | {self.container}")
-                            self.failed_layers.append(f'{self.container} | {ln}')
-                            pass
-
-                except FileNotFoundError as e:
-                    self.layer_errors.append(f"{datetime.now().strftime('%Y-%m-%dT%H:%M:%S')} - FileNotFound - {e}")
-                    pass
+            # read the layer extents, one layer per worker, then reproject them one CRS at a time
+            by_crs = defaultdict(list)
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                for layer in executor.map(self._layer_extent, range(self.get_layer_count())):
+                    if layer:
+                        by_crs[layer[1]].append(layer)
+
+            for lyr_crs, layers in by_crs.items():
+                feats.extend(self._layer_records(lyr_crs, layers, dt))
 
         elif ext in ['kml', 'kmz']:  # it's a kml file
             dt = 'KML'
             try:
                 minx, miny, maxx, maxy = kmlextents(self.container)
-                boundary = Polygon([
-                    [minx, miny],
-                    [maxx, miny],
-                    [maxx, maxy],
-                    [minx, maxy]
-                ])
+                boundary = bbox_geometry(minx, miny, maxx, maxy)
 
                 feats.append(get_geojson_record(
                     geom=boundary,
@@ -122,7 +197,7 @@ class Container:
 
             except Exception as e:
                 self.layer_errors.append(f"{datetime.now().strftime('%Y-%m-%dT%H:%M:%S')} - {e} - {self.container}")
-                return None
+                self.failed_layers.append(self.container)
 
         return {'feats': feats,
                 'errors': self.layer_errors,
@@ -130,37 +205,28 @@ class Container:
 
 
 class Exif(object):
+    CATEGORY = 'web_images'
+    GPS_IFD = 0x8825
     exif_data = None
-    image = None
 
     def __init__(self, img_path):
         self.img_path = img_path
-        self.image = Image.open(img_path)
-        self.get_exif_data()
         super(Exif, self).__init__()
 
         self.dt = 'JPEG Image'
 
     def get_exif_data(self):
         """
-        Opens an Exif instance (jpg format), determines if GPS coordinates are available,
-        and returns location as a geojson point object.
+        Reads the GPS tags of an image (jpg format) into {'GPSInfo': {tag name: value}}.  Only the headers are
+        parsed, the pixel data is never decoded, and the file is closed as soon as the GPS IFD has been read.
 
-        :return: json
+        :return: dict
         """
         exif_data = {}
-        info = self.image._getexif()
-        if info:
-            for tag, value in info.items():
-                decoded = TAGS.get(tag, tag)
-                if decoded == 'GPSInfo':
-                    gps_data = {}
-                    for t in value:
-                        sub_decoded = GPSTAGS.get(t, t)
-                        gps_data[sub_decoded] = value[t]
-                    exif_data[decoded] = gps_data
-                else:
-                    exif_data[decoded] = value
+        with Image.open(self.img_path) as image:
+            gps = image.getexif().get_ifd(Exif.GPS_IFD)
+        if gps:
+            exif_data['GPSInfo'] = {GPSTAGS.get(t, t): v for t, v in gps.items()}
         self.exif_data = exif_data
         return exif_data
 
@@ -172,7 +238,16 @@ class Exif(object):
 
     @staticmethod
     def convert_to_degrees(value):
-        return value[0] + (value[1] / 60.0) + (value[2] / 3600.0)
+        """
+        Degrees, minutes and seconds to decimal degrees, or None if a rational has a zero denominator.
+
+        :return: float
+        """
+        try:
+            dd = float(value[0]) + (float(value[1]) / 60.0) + (float(value[2]) / 3600.0)
+        except ZeroDivisionError:
+            return None
+        return dd if isfinite(dd) else None
 
     def get_props(self):
         lat = None
@@ -189,14 +264,14 @@ class Exif(object):
 
                 if gps_lat and gps_lat_ref and gps_lon and gps_lon_ref:
                     lat = self.convert_to_degrees(gps_lat)
-                    if gps_lat_ref == 'S':
+                    if lat is not None and gps_lat_ref == 'S':
                         lat = 0 - lat
                     lon = self.convert_to_degrees(gps_lon)
-                    if gps_lon_ref == 'W':
+                    if lon is not None and gps_lon_ref == 'W':
                         lon = 0 - lon
 
-            if lat and lon:
-                point = Point(lat, lon)
+            if lat is not None and lon is not None:
+                point = {"type": "Point", "coordinates": (lon, lat)}
 
                 return get_geojson_record(geom=point,
                                           datatype=self.dt,
@@ -211,6 +286,8 @@ class Exif(object):
 
 class Lidar:
 
+    CATEGORY = 'lidar_point_clouds'
+
     def __init__(self, lidar_file):
         """
         Constructor.  Requires input lidar file (*.las, *.laz).
@@ -230,7 +307,7 @@ class Lidar:
                     stderr=sp.PIPE,
                     stdout=sp.PIPE))
 
-        return json.loads(r.stdout.decode())
+        return _loads(r.stdout)
 
     def get_props(self):
         """
@@ -242,40 +319,29 @@ class Lidar:
 
         # local parameters
         path, fname = os.path.split(self.lidar_file)
-        stats = Lidar._run_pdal(self)
 
         try:
-            # Read metadata
-            md = stats['metadata']
-
-            # Get native CRS and project to WGS84
-            cmpd_crs = json.loads(
-                CRS.to_json(
-                    CRS.from_wkt(md['comp_spatialreference'])
-                )
-            )
-            native_crs = cmpd_crs['components'][0]['id']['code']
-            bounds = md['minx'], md['miny'], md['maxx'], md['maxy']
-
-            if native_crs != 4326:
-                minx, miny, maxx, maxy = to_wgs84(native_crs, bounds)
+            # Read the header directly, and only ask PDAL when the CRS is not a plain EPSG GeoKey
+            header = lasextents(self.lidar_file)
+            if header:
+                native_crs, bounds = header
             else:
-                minx, miny, maxx, maxy = bounds[0], bounds[1], bounds[2], bounds[3]
+                md = Lidar._run_pdal(self)['metadata']
+                native_crs = _epsg_from_wkt(md['comp_spatialreference'])
+                bounds = md['minx'], md['miny'], md['maxx'], md['maxy']
+
+            # Project to WGS84
+            minx, miny, maxx, maxy = to_wgs84(native_crs, bounds)
 
             # Create the geometry
-            boundary = Polygon([
-                [minx, miny],
-                [maxx, miny],
-                [maxx, maxy],
-                [minx, maxy]
-            ])
+            boundary = bbox_geometry(minx, miny, maxx, maxy)
 
             return get_geojson_record(
                 geom=boundary,
                 datatype="Lidar",
                 fname=fname,
                 path=path,
-                nativecrs=cmpd_crs['components'][0]['id']['code'],
+                nativecrs=native_crs,
                 lastmod=moddate(self.lidar_file)
             )
 
@@ -285,6 +351,8 @@ class Lidar:
 
 class Raster:
 
+    CATEGORY = 'rasters'
+
     def __init__(self, raster_file):
         self.raster_file = raster_file
 
@@ -304,56 +372,45 @@ class Raster:
             dt = 'Raster'
 
         try:
-            with rasterio.open(self.raster_file) as r:
+            with rasterio.Env(**RASTER_OPEN_OPTIONS), rasterio.open(self.raster_file) as r:
                 try:
                     epsg = r.crs.to_epsg()
                     bounds = r.bounds
                     if epsg:
-                        if epsg != 4326:
-                            bounds = bounds.left, bounds.bottom, bounds.right, bounds.top
-                            minx, miny, maxx, maxy = to_wgs84(epsg, bounds)
-                        else:
-                            minx, miny, maxx, maxy = bounds.left, bounds.bottom, bounds.right, bounds.top
-
-                        boundary = Polygon([
-                            [minx, miny],
-                            [maxx, miny],
-                            [maxx, maxy],
-                            [minx, maxy]
-                        ])
+                        minx, miny, maxx, maxy = to_wgs84(epsg, (bounds.left, bounds.bottom,
+                                                                 bounds.right, bounds.top))
+
+                        boundary = bbox_geometry(minx, miny, maxx, maxy)
 
                         return get_geojson_record(geom=boundary,
                                                   datatype=dt,
                                                   fname=os.path.split(self.raster_file)[1],
                                                   path=os.path.split(self.raster_file)[0],
-                                                  nativecrs=r.crs.to_epsg(),
+                                                  nativecrs=epsg,
                                                   lastmod=moddate(self.raster_file))
                 except Exception:
                     try:
-                        ds = gdal.Open(self.raster_file)
-                        md = ds.GetMetadata()
-                        filename = md.get('NITF_FTITLE', os.path.split(self.raster_file)[1])
-                        for k, v in md.items():
-                            if k == 'NITF_IGEOLO':
-                                bounds_str = v
-                                orig_coords = dms_to_dd(bounds_str[30:45])
-                                b_coords = dms_to_dd(bounds_str[45:])
-                                c_coords = dms_to_dd(bounds_str[:15])
-                                d_coords = dms_to_dd(bounds_str[15:30])
-
-                                boundary = Polygon([
-                                    [orig_coords[1], orig_coords[0]],
-                                    [b_coords[1], b_coords[0]],
-                                    [c_coords[1], c_coords[0]],
-                                    [d_coords[1], d_coords[0]]
-                                ])
-
-                                return get_geojson_record(geom=boundary,
-                                                          datatype=dt,
-                                                          fname=filename,
-                                                          path=os.path.split(self.raster_file)[0],
-                                                          nativecrs=4326,
-                                                          lastmod=moddate(self.raster_file))
+                        ds = gdal.OpenEx(self.raster_file, gdal.OF_RASTER | gdal.OF_READONLY)
+                        # Look up the two items needed rather than copying the whole NITF metadata domain
+                        bounds_str = ds.GetMetadataItem('NITF_IGEOLO')
+                        if bounds_str:
+                            filename = ds.GetMetadataItem('NITF_FTITLE')
+                            if filename is None:
+                                filename = os.path.split(self.raster_file)[1]
+                            orig_coords = dms_to_dd(bounds_str[30:45])
+                            b_coords = dms_to_dd(bounds_str[45:])
+                            c_coords = dms_to_dd(bounds_str[:15])
+                            d_coords = dms_to_dd(bounds_str[15:30])
+
+                            ring = tuple((lon, lat) for lat, lon in (orig_coords, b_coords, c_coords, d_coords))
+                            boundary = {"type": "Polygon", "coordinates": (ring + ring[:1],)}
+
+                            return get_geojson_record(geom=boundary,
+                                                      datatype=dt,
+                                                      fname=filename,
+                                                      path=os.path.split(self.raster_file)[0],
+                                                      nativecrs=4326,
+                                                      lastmod=moddate(self.raster_file))
 
                     except Exception:
                         pass
@@ -364,6 +421,8 @@ class Raster:
 
 class Shapefile:
 
+    CATEGORY = 'shapefiles'
+
     def __init__(self, shpfile):
         self.shp = shpfile
 
@@ -375,17 +434,10 @@ class Shapefile:
             org_crs = lyr.GetSpatialRef()
             org_crs = int(org_crs.GetAttrValue('AUTHORITY', 1))
 
-            if org_crs != 4326:
-                minx, maxx, miny, maxy = to_wgs84(org_crs, lyr.GetExtent())
-            else:
-                minx, maxx, miny, maxy = lyr.GetExtent()
+            minx, maxx, miny, maxy = lyr.GetExtent()
+            minx, miny, maxx, maxy = to_wgs84(org_crs, (minx, miny, maxx, maxy))
 
-            boundary = Polygon([
-                [minx, miny],
-                [maxx, miny],
-                [maxx, maxy],
-                [minx, maxy]
-            ])
+            boundary = bbox_geometry(minx, miny, maxx, maxy)
 
             return get_geojson_record(geom=boundary,
                                       datatype='Shapefile',
@@ -394,8 +446,8 @@ class Shapefile:
                                       nativecrs=org_crs,
                                       lastmod=moddate(self.shp))
 
-        except Exception as e:
-            return e
+        except Exception:
+            return None
 
 
 # static methods
@@ -425,118 +477,132 @@ def get_centroid(geom):
     return geom.centroid
 
 
+def bbox_geometry(minx, miny, maxx, maxy):
+    """
+    GeoJSON Polygon for a bounding box, with the same ring shapely's box() and mapping() produce, built without
+    creating a shapely geometry.
+
+    :return: dict
+    """
+    return {"type": "Polygon",
+            "coordinates": (((maxx, miny), (maxx, maxy), (minx, maxy), (minx, miny), (maxx, miny)),)}
+
+
 def get_geojson_record(geom, datatype, fname, path, nativecrs, lastmod, img_popup=None):
+    properties = {"dataType": datatype,
+                  "fname": fname,
+                  "path": f'file:///{path}'}
     if img_popup:
-        return {"type": "Feature",
-                "geometry": mapping(geom),
-                "properties": OrderedDict([
-                    ("dataType", datatype),
-                    ("fname", fname),
-                    ("path", f'file:///{path}'),
-                    ("img_popup", f'file:///{img_popup}'),
-                    ("native_crs", nativecrs),
-                    ("lastmod", lastmod)
-                ])}
-    else:
-        return {"type": "Feature",
-                "geometry": mapping(geom),
-                "properties": OrderedDict([
-                    ("dataType", datatype),
-                    ("fname", fname),
-                    ("path", f'file:///{path}'),
-                    ("native_crs", nativecrs),
-                    ("lastmod", lastmod)
-                ])}
-
-
-# def get_geojson_record(geom, datatype, fname, path, nativecrs, lastmod, img_popup=None):
-#     if img_popup:
-#         return json.dumps({"type": "Feature",
-#                            "geometry": mapping(geom),
-#                            "properties": OrderedDict([
-#                                ("dataType", datatype),
-#                                ("fname", fname),
-#                                ("path", f'file:///{path}'),
-#                                ("img_popup", f'file:///{img_popup}'),
-#                                ("native_crs", nativecrs),
-#                                ("lastmod", lastmod)
-#                            ])})
-#     else:
-#         return json.dumps({"type": "Feature",
-#                            "geometry": mapping(geom),
-#                            "properties": OrderedDict([
-#                                ("dataType", datatype),
-#                                ("fname", fname),
-#                                ("path", f'file:///{path}'),
-#                                ("native_crs", nativecrs),
-#                                ("lastmod", lastmod)
-#                            ])})
+        properties["img_popup"] = f'file:///{img_popup}'
+    properties["native_crs"] = nativecrs
+    properties["lastmod"] = lastmod
+
+    return {"type": "Feature",
+            "geometry": geom if isinstance(geom, dict) else mapping(geom),
+            "properties": properties}
+
+
+def lasextents(lasfile):
+    """
+    Reads the horizontal EPSG code and (minx, miny, maxx, maxy) extent of a LAS/LAZ file from its public header
+    and GeoTIFF key VLR, without starting PDAL.  Returns None when the file cannot be read this way, e.g. a
+    CRS stored only as WKT.
+
+    :return: tuple
+    """
+    try:
+        with open(lasfile, 'rb') as f:
+            sig, encoding, header_size, _, vlr_count, maxx, minx, maxy, miny = _LAS_HEADER.unpack(
+                f.read(_LAS_HEADER.size))
+            if sig != b'LASF' or encoding & _LAS_WKT_BIT:
+                return None
 
+            f.seek(header_size)
+            for _ in range(vlr_count):
+                user_id, record_id, length = _LAS_VLR_HEADER.unpack(f.read(_LAS_VLR_HEADER.size))
+                if user_id.rstrip(b'\0') != b'LASF_Projection' or record_id != 34735:
+                    f.seek(length, os.SEEK_CUR)
+                    continue
+
+                # GeoKeyDirectoryTag: a four-short header, then (key, location, count, value) entries
+                keys = struct.unpack(f'<{length // 2}H', f.read(length - length % 2))
+                geokeys = {keys[i]: keys[i + 3] for i in range(4, 4 + 4 * keys[3], 4) if keys[i + 1] == 0}
+                epsg = geokeys.get(_GEOKEY_PROJECTED_CS) or geokeys.get(_GEOKEY_GEOGRAPHIC_CS)
+                if epsg and epsg != 32767:  # 32767 is user-defined
+                    return epsg, (minx, miny, maxx, maxy)
+                return None
 
-def kmlextents(kmlfile):
-    yf = []
-    xf = []
-    data = None
+    except (OSError, struct.error, IndexError):
+        pass
 
-    if type(kmlfile) is str:
-        if kmlfile.lower().endswith('kmz'):  # It's a KMZ and has to be unzipped
-            data = openkmz(kmlfile)
-        elif kmlfile.lower().endswith('kml'):  # It's a KML and does not have to be unzipped
-            data = openkml(kmlfile)
+    return None
 
-        data = data.replace('\n', '').replace('\r', '').replace('\t', '')
 
-        try:
-            ys = re.findall(r'<latitude>(.+?)</latitude>', data)
-            xs = re.findall(r'<longitude>(.+?)</longitude>', data)
+def kmlextents(kmlfile):
+    """
+    Streams a KML (or the KML enclosed in a KMZ) and returns its (minx, miny, maxx, maxy) extent, or None.
+    <latitude>/<longitude> values are used when the document has both, otherwise every <coordinates> tuple.
+    Only running bounds are kept, so memory does not grow with the size of the file.
+
+    :return: tuple
+    """
+    if type(kmlfile) is not str:
+        return None
 
-            if len(xs) > 0 and len(ys) > 0:
-                for x in xs:
-                    xf.append(float(x))
-                for y in ys:
-                    yf.append(float(y))
+    if kmlfile.lower().endswith('kmz'):  # It's a KMZ; stream the enclosed KML straight out of the archive
+        with ZipFile(kmlfile) as kmz:
+            name = _kmz_member(kmz)
+            if name is None:
+                return None
+            with kmz.open(name) as source:
+                return _kml_bounds(source)
+    elif kmlfile.lower().endswith('kml'):  # It's a KML and does not have to be unzipped
+        return _kml_bounds(kmlfile)
+    else:
+        return None
 
-            else:
-                try:
-                    coords = re.findall(r'<coordinates>(.+?)</coordinates>', data)
-
-                    for coord in coords:
-                        try:
-                            coord = coord.lstrip().split(' ')
-                            for c in coord:
-                                try:
-                                    c = c.lstrip().split(' ')
-                                    for i in c:
-                                        x, y, z = i.split(',')
-                                        xf.append(float(x))
-                                        yf.append(float(y))
-                                except Exception:
-                                    try:
-                                        print(c.split(','))
-                                        x, y, z = c.split(',')
-                                        xf.append(float(x))
-                                        yf.append(float(y))
-
-                                    except Exception:
-                                        pass
-
-                        except Exception:
-                            pass
 
-                except Exception:
-                    pass
+def _kml_bounds(source):
+    """
+    Single streaming pass over a KML path or binary file object, returning its (minx, miny, maxx, maxy) or None.
 
-        except Exception:
-            pass
+    :return: tuple
+    """
+    inf = float('inf')
+    lon_bounds = [inf, -inf]
+    lat_bounds = [inf, -inf]
+    x_bounds = [inf, -inf]
+    y_bounds = [inf, -inf]
 
-    if len(xf) > 0 and len(yf) > 0:
-        minx = min(xf)
-        miny = min(yf)
-        maxx = max(xf)
-        maxy = max(yf)
+    try:
+        for _, elem in ElementTree.iterparse(source):
+            tag = elem.tag.rpartition('}')[2]
+            text = elem.text
+            if text:
+                try:
+                    if tag == 'coordinates':
+                        for coord in text.split():
+                            xyz = coord.split(',')
+                            x, y = float(xyz[0]), float(xyz[1])
+                            x_bounds[0], x_bounds[1] = min(x_bounds[0], x), max(x_bounds[1], x)
+                            y_bounds[0], y_bounds[1] = min(y_bounds[0], y), max(y_bounds[1], y)
+                    elif tag == 'longitude':
+                        x = float(text)
+                        lon_bounds[0], lon_bounds[1] = min(lon_bounds[0], x), max(lon_bounds[1], x)
+                    elif tag == 'latitude':
+                        y = float(text)
+                        lat_bounds[0], lat_bounds[1] = min(lat_bounds[0], y), max(lat_bounds[1], y)
+                except (ValueError, IndexError):
+                    pass
+            elem.clear()
 
-        return minx, miny, maxx, maxy
+    except ElementTree.ParseError:
+        pass
 
+    if lon_bounds[0] != inf and lat_bounds[0] != inf:
+        return lon_bounds[0], lat_bounds[0], lon_bounds[1], lat_bounds[1]
+    elif x_bounds[0] != inf:
+        return x_bounds[0], y_bounds[0], x_bounds[1], y_bounds[1]
     else:
         return None
 
@@ -546,23 +612,87 @@ def moddate(filename):
     return datetime.fromtimestamp(lm).strftime('%Y-%m-%dT%H:%M:%S')
 
 
-def openkml(kml):
-    with open(kml, 'r') as okml:
-        data = okml.read()
-    return data
+def _kmz_member(kmz):
+    """
+    Name of the doc.kml or other KML enclosed in an open KMZ, or None.
+
+    :return: str
+    """
+    return next((n for n in kmz.namelist() if n.lower().endswith('kml')), None)
 
 
 def openkmz(kmz):
-    data = None
-    for n in ZipFile(kmz).namelist():
-        if n.lower().endswith('kml'):  # get the doc.kml or other enclosed kml
-            with ZipFile(kmz, 'r') as kml:
-                data = kml.read(n).decode(encoding='utf8')
-    return data
+    with ZipFile(kmz) as z:
+        name = _kmz_member(z)
+        return z.read(name).decode(encoding='utf8') if name else None
+
+
+@lru_cache(maxsize=128)
+def _epsg_from_wkt(wkt):
+    """
+    EPSG code of a CRS given as WKT, taking the horizontal component of a compound CRS.  Tiles from one survey
+    normally share a single CRS string, so each distinct WKT is only parsed by pyproj once.
+
+    :return: int
+    """
+    crs = CRS.from_wkt(wkt)
+    if crs.is_compound:
+        crs = crs.sub_crs_list[0]
+    return crs.to_epsg()
+
+
+_transformer_lock = threading.RLock()
+
+
+@lru_cache(maxsize=512)
+def _get_transformer(src_epsg, dst_epsg=4326):
+    """
+    Builds (once per CRS pair) the pyproj Transformer between two EPSG codes.  Compiling the PROJ pipeline
+    is the expensive part of a reprojection, so Transformers are reused across layers and files.  The cache
+    holds every UTM zone in both hemispheres with room to spare; long-running processes can release it with
+    _get_transformer.cache_clear().
+    """
+    return pyproj.Transformer.from_crs(src_epsg, dst_epsg, always_xy=True)
 
 
 def to_wgs84(native_epsg, bounds):
-    proj = pyproj.Transformer.from_crs(native_epsg, 4326, always_xy=True)
-    minx, miny = proj.transform(bounds[0], bounds[1])
-    maxx, maxy = proj.transform(bounds[2], bounds[3])
-    return minx, miny, maxx, maxy
+    """
+    Reprojects a (minx, miny, maxx, maxy) bounding box to WGS84.  All four corners are transformed in a
+    single call and the envelope of the result is returned, since a projected rectangle is rarely still
+    axis-aligned in geographic coordinates.  Bounds already in WGS84 are returned as they are.
+
+    :return: tuple
+    """
+    minx, miny, maxx, maxy = bounds
+
+    # Codes arrive as int or str depending on the handler; normalise so both share one cache entry
+    native_epsg = int(native_epsg)
+    if native_epsg == 4326:
+        return minx, miny, maxx, maxy
+
+    with _transformer_lock:
+        proj = _get_transformer(native_epsg)
+    xs, ys = proj.transform([minx, maxx, maxx, minx], [miny, miny, maxy, maxy])
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def to_wgs84_many(native_epsg, bounds):
+    """
+    Reprojects a sequence of (minx, miny, maxx, maxy) bounding boxes sharing one CRS to WGS84.  The corners
+    of every box go through a single transform call, so the fixed per-call cost of pyproj is paid once per
+    CRS rather than once per box.
+
+    :return: list
+    """
+    native_epsg = int(native_epsg)
+    b = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+    if native_epsg == 4326:
+        return [tuple(row) for row in b.tolist()]
+
+    with _transformer_lock:
+        proj = _get_transformer(native_epsg)
+    xs, ys = proj.transform(b[:, [0, 2, 2, 0]].ravel(), b[:, [1, 1, 3, 3]].ravel())
+    xs = np.asarray(xs).reshape(-1, 4)
+    ys = np.asarray(ys).reshape(-1, 4)
+    return list(zip(xs.min(axis=1).tolist(), ys.min(axis=1).tolist(),
+                    xs.max(axis=1).tolist(), ys.max(axis=1).tolist()))